@@ -3,11 +3,24 @@
 # This source code is licensed under the MIT license found in the
 # LICENSE file in the root directory of this source tree.
 
+import collections.abc
 import dataclasses
-from contextlib import ExitStack
-from dataclasses import dataclass
-from typing import Any, Callable, Iterable, List, Optional, Sequence, Type
-from unittest.mock import patch
+from dataclasses import dataclass, field
+from enum import auto, Enum
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    get_type_hints,
+    Iterable,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+    Type,
+)
+
+from typing_inspect import get_args, get_origin, is_literal_type, is_union_type
 
 import libcst as cst
 from libcst._nodes.internal import CodegenState, visit_required
@@ -18,11 +31,200 @@ from libcst.metadata.position_provider import PositionProvidingCodegenState
 from libcst.testing.utils import UnitTest
 
 
-@dataclass(frozen=True)
-class _CSTCodegenPatchTarget:
-    type: Type[cst.CSTNode]
-    name: str
-    old_codegen: Callable[..., None]
+# Every `CSTNode` subclass exported by the `cst` module, computed once at import time
+# instead of rescanning `cst.__dict__` for every test.
+_CST_NODE_CLASSES: Tuple[Tuple[str, Type[cst.CSTNode]], ...] = tuple(
+    (k, v)
+    for (k, v) in cst.__dict__.items()
+    if isinstance(v, type) and issubclass(v, cst.CSTNode) and hasattr(v, "_codegen")
+)
+
+# Only the classes that define `_codegen` in their own `__dict__` need patching. We
+# collect those from the MRO of every exported class, not just from the exported
+# classes themselves, so an exported class that inherits `_codegen` from a base that
+# isn't exported is still covered. Every exported class then inherits a patched method
+# from the nearest class that defines one, which is the same `_codegen` it would have
+# called unpatched. Each patched class gets its own tracking `_codegen` (see
+# `_TRACKING_CODEGENS`) that forwards to exactly this original, so `super()._codegen()`
+# chains between patched classes still work.
+#
+# Node classes that aren't reachable from `cst`'s exports (e.g. ones defined in a test)
+# and override `_codegen` themselves aren't patched, so this only tracks them through
+# `super()._codegen()`.
+_OWN_CODEGENS: Dict[type, Callable[..., None]] = {
+    base: base.__dict__["_codegen"]
+    for (_, cls) in _CST_NODE_CLASSES
+    for base in cls.__mro__
+    if "_codegen" in base.__dict__
+}
+
+# `Module.code_for_node` only threads state through a fresh `CodegenState`, so a
+# single empty module can be shared by every codegen call in these tests.
+_EMPTY_MODULE: cst.Module = cst.Module([])
+
+
+class _FieldKind(Enum):
+    # The field holds a single `CSTNode` (or something that isn't a node, like `None`).
+    NODE = auto()
+    # The field holds a sequence of `CSTNode`s (or possibly a single node or `None`).
+    NODE_SEQUENCE = auto()
+    # We can't tell from the field's annotation, so the value has to be inspected.
+    UNKNOWN = auto()
+
+
+# pyre-fixme[2]: Parameter annotation cannot be `Any`.
+def _is_pure_node_hint(hint: Any) -> bool:
+    """
+    Returns `True` if every value matching `hint` is a `CSTNode`.
+    """
+    if is_union_type(hint):
+        return all(_is_pure_node_hint(arg) for arg in get_args(hint, evaluate=True))
+    return isinstance(hint, type) and issubclass(hint, cst.CSTNode)
+
+
+# pyre-fixme[2]: Parameter annotation cannot be `Any`.
+def _classify_hint(hint: Any) -> Optional[_FieldKind]:
+    """
+    Returns `None` if a field annotated with `hint` can never hold a child node.
+    """
+    if hint is Any:
+        return _FieldKind.UNKNOWN
+    if is_union_type(hint):
+        args = get_args(hint, evaluate=True)
+        kinds = [_classify_hint(arg) for arg in args]
+        if _FieldKind.UNKNOWN in kinds:
+            return _FieldKind.UNKNOWN
+        if _FieldKind.NODE_SEQUENCE in kinds:
+            # Only a node or `None` can safely stand in for the sequence. Anything else
+            # (e.g. a string) would be iterated as if it were a sequence of nodes.
+            if all(
+                kind is not None or arg is type(None) for arg, kind in zip(args, kinds)
+            ):
+                return _FieldKind.NODE_SEQUENCE
+            return _FieldKind.UNKNOWN
+        if _FieldKind.NODE in kinds:
+            # The other members can never hold a node, and single node values are
+            # always checked with `isinstance`.
+            return _FieldKind.NODE
+        return None
+    if isinstance(hint, type) and issubclass(hint, cst.CSTNode):
+        return _FieldKind.NODE
+    if get_origin(hint) is collections.abc.Sequence:
+        args = get_args(hint, evaluate=True)
+        if not args:
+            return _FieldKind.UNKNOWN
+        if _is_pure_node_hint(args[0]):
+            return _FieldKind.NODE_SEQUENCE
+        if _classify_hint(args[0]) is None:
+            return None
+        # Some elements may be nodes and some may not (e.g. `Sequence[Union[Name,
+        # str]]`), so the elements have to be inspected.
+        return _FieldKind.UNKNOWN
+    if hint is type(None) or is_literal_type(hint):
+        return None
+    if (
+        isinstance(hint, type)
+        # `object` and the like could still hold a node.
+        and not issubclass(cst.CSTNode, hint)
+        # Containers could hold nodes, but strings can't.
+        and (
+            issubclass(hint, (str, bytes))
+            or not issubclass(hint, collections.abc.Iterable)
+        )
+    ):
+        return None
+    return _FieldKind.UNKNOWN
+
+
+def _compute_field_info(
+    cls: Type[cst.CSTNode],
+) -> Tuple[Tuple[str, _FieldKind], ...]:
+    try:
+        hints = get_type_hints(cls)
+    except (NameError, TypeError):
+        # e.g. a node defined in a test with a forward reference we can't resolve.
+        # Inspect all of its fields' values instead.
+        return tuple((f.name, _FieldKind.UNKNOWN) for f in dataclasses.fields(cls))
+    field_info = []
+    for f in dataclasses.fields(cls):
+        kind = _classify_hint(hints[f.name])
+        if kind is not None:
+            field_info.append((f.name, kind))
+    return tuple(field_info)
+
+
+# Memoizes `_classify_fields` per node class, without storing test-only state on the
+# library's classes.
+_FIELD_INFO: Dict[Type[cst.CSTNode], Tuple[Tuple[str, _FieldKind], ...]] = {}
+
+
+def _classify_fields(cls: Type[cst.CSTNode]) -> Tuple[Tuple[str, _FieldKind], ...]:
+    """
+    Returns a `(field_name, kind)` pair for every dataclass field on `cls` whose type
+    annotation can hold a `CSTNode` or a sequence of them. Fields whose annotation
+    rules out child nodes (whitespace strings, operators' values, etc.) are omitted.
+    Fields with annotations we don't recognize (`Any`, `object`, a bare `Sequence`,
+    ...) are classified as `_FieldKind.UNKNOWN`, and their values must be inspected.
+    """
+    info = _FIELD_INFO.get(cls)
+    if info is None:
+        info = _FIELD_INFO[cls] = _compute_field_info(cls)
+    return info
+
+
+@dataclass
+class _CodegenChildTracker:
+    """
+    State for a single codegen tracking pass in
+    `CSTNodeTest.__derive_children_from_codegen`.
+    """
+
+    children: List[cst.CSTNode] = field(default_factory=list)
+    # How many distinct nodes are currently being rendered, and the innermost one. This
+    # is all we need to know of the stack of nodes being rendered.
+    depth: int = 0
+    last: Optional[cst.CSTNode] = None
+
+
+# Only set while a codegen tracking pass is running.
+_codegen_tracker: Optional[_CodegenChildTracker] = None
+
+
+def _make_tracking_codegen(original: Callable[..., None]) -> Callable[..., None]:
+    def _tracking_codegen(self: cst.CSTNode, *args: Any, **kwargs: Any) -> None:
+        """
+        Installed as `_codegen` during a codegen tracking pass. Records the direct
+        children of the first node rendered, and then forwards to `original`.
+        """
+        tracker = _codegen_tracker
+        assert tracker is not None, "_codegen called outside of a tracking pass"
+        # Don't count the same node twice. This is needed so that we don't track
+        # calls to `super()._codegen()`.
+        if tracker.last is self:
+            original(self, *args, **kwargs)
+            return
+        # Check the depth to see that we're a direct child, not the root or a
+        # transitive child.
+        if tracker.depth == 1:
+            tracker.children.append(self)
+        prev = tracker.last
+        tracker.depth += 1
+        tracker.last = self
+        original(self, *args, **kwargs)
+        tracker.depth -= 1
+        tracker.last = prev
+
+    return _tracking_codegen
+
+
+# One tracking `_codegen` per patched class, built once at import time instead of for
+# every test. Each one forwards to the `_codegen` its own class defines, so a
+# `super()._codegen()` call reaches the base class's tracking `_codegen` and then the
+# base class's original.
+_TRACKING_CODEGENS: Dict[type, Callable[..., None]] = {
+    cls: _make_tracking_codegen(own_codegen)
+    for cls, own_codegen in _OWN_CODEGENS.items()
+}
 
 
 class _NOOPVisitor(CSTTransformer):
@@ -61,9 +263,8 @@ class CSTNodeTest(UnitTest):
         # value instead of identity (what `CSTNode.__eq__` does) for tests.
         #
         # The time complexity of CSTNode.deep_equals doesn't matter much inside tests.
-        for v in cst.__dict__.values():
-            if isinstance(v, type) and issubclass(v, cst.CSTNode):
-                self.addTypeEqualityFunc(v, _cst_node_equality_func)
+        for _, v in _CST_NODE_CLASSES:
+            self.addTypeEqualityFunc(v, _cst_node_equality_func)
         self.addTypeEqualityFunc(DummyIndentedBlock, _cst_node_equality_func)
 
     def validate_node(
@@ -83,7 +284,7 @@ class CSTNodeTest(UnitTest):
         # Tests of children should unwrap DummyIndentedBlock first, because we don't
         # want to test DummyIndentedBlock's behavior.
         unwrapped_node = node
-        while isinstance(unwrapped_node, DummyIndentedBlock):
+        while type(unwrapped_node) is DummyIndentedBlock:
             unwrapped_node = unwrapped_node.child
         self.__assert_children_match_codegen(unwrapped_node)
         self.__assert_children_match_fields(unwrapped_node)
@@ -110,7 +311,7 @@ class CSTNodeTest(UnitTest):
         """
         Verifies that the given node's `_codegen` method is correct.
         """
-        module = cst.Module([])
+        module = _EMPTY_MODULE
         self.assertEqual(module.code_for_node(node), expected)
 
         if expected_position is not None:
@@ -132,23 +333,28 @@ class CSTNodeTest(UnitTest):
     def __assert_children_match_codegen(self, node: cst.CSTNode) -> None:
         children = node.children
         codegen_children = self.__derive_children_from_codegen(node)
-        self.assertSequenceEqual(
-            children,
-            codegen_children,
-            msg=(
-                "The list of children we got from `node.children` differs from the "
-                + "children that were visited by `node._codegen`. This is probably "
-                + "due to a mismatch between _visit_and_replace_children and "
-                + "_codegen_impl."
-            ),
-        )
+        # `CSTNode.__eq__` compares by identity, so check that directly and only fall
+        # back to `assertSequenceEqual` (for its diff) when something differs.
+        if len(children) != len(codegen_children) or any(
+            a is not b for a, b in zip(children, codegen_children)
+        ):
+            self.assertSequenceEqual(
+                children,
+                codegen_children,
+                msg=(
+                    "The list of children we got from `node.children` differs from "
+                    + "the children that were visited by `node._codegen`. This is "
+                    + "probably due to a mismatch between _visit_and_replace_children "
+                    + "and _codegen_impl."
+                ),
+            )
 
     def __derive_children_from_codegen(
         self, node: cst.CSTNode
     ) -> Sequence[cst.CSTNode]:
         """
-        Patches all subclasses of `CSTNode` exported by the `cst` module to track which
-        `_codegen` methods get called, generating a list of children.
+        Patches the `_codegen` methods of the `CSTNode` subclasses exported by the `cst`
+        module to track which nodes get rendered, generating a list of children.
 
         Because all children must be rendered out into lexical order, this should be
         equivalent to `node.children`.
@@ -158,47 +364,24 @@ class CSTNodeTest(UnitTest):
         are in sync.
         """
 
-        patch_targets: Iterable[_CSTCodegenPatchTarget] = [
-            _CSTCodegenPatchTarget(type=v, name=k, old_codegen=v._codegen)
-            for (k, v) in cst.__dict__.items()
-            if isinstance(v, type)
-            and issubclass(v, cst.CSTNode)
-            and hasattr(v, "_codegen")
-        ]
-
-        children: List[cst.CSTNode] = []
-        codegen_stack: List[cst.CSTNode] = []
-
-        def _get_codegen_override(
-            target: _CSTCodegenPatchTarget,
-        ) -> Callable[..., None]:
-            def _codegen_impl(self: CSTNodeT, *args: Any, **kwargs: Any) -> None:
-                should_pop = False
-                # Don't stick duplicates in the stack. This is needed so that we don't
-                # track calls to `super()._codegen()`.
-                if len(codegen_stack) == 0 or codegen_stack[-1] is not self:
-                    # Check the stack to see that we're a direct child, not the root or
-                    # a transitive child.
-                    if len(codegen_stack) == 1:
-                        children.append(self)
-                    codegen_stack.append(self)
-                    should_pop = True
-                target.old_codegen(self, *args, **kwargs)
-                # only pop if we pushed something to the stack earlier
-                if should_pop:
-                    codegen_stack.pop()
-
-            return _codegen_impl
-
-        with ExitStack() as patch_stack:
-            for t in patch_targets:
-                patch_stack.enter_context(
-                    patch(f"libcst.{t.name}._codegen", _get_codegen_override(t))
-                )
+        global _codegen_tracker
+
+        # Swap the `_codegen` attributes directly instead of going through
+        # `unittest.mock.patch`, which is surprisingly expensive when repeated for
+        # every node class in every test. The tracking `_codegen` methods are built
+        # once at import time, so there's nothing to allocate per class here.
+        tracker = _codegen_tracker = _CodegenChildTracker()
+        for cls, tracking_codegen in _TRACKING_CODEGENS.items():
+            setattr(cls, "_codegen", tracking_codegen)
+        try:
             # Execute `node._codegen()`
-            cst.Module([]).code_for_node(node)
+            _EMPTY_MODULE.code_for_node(node)
+        finally:
+            _codegen_tracker = None
+            for cls, own_codegen in _OWN_CODEGENS.items():
+                setattr(cls, "_codegen", own_codegen)
 
-        return children
+        return tracker.children
 
     def __assert_children_match_fields(self, node: cst.CSTNode) -> None:
         """
@@ -207,24 +390,36 @@ class CSTNodeTest(UnitTest):
 
         If you want to verify order as well, use `assert_children_ordered`.
         """
-        node_children_ids = {id(child) for child in node.children}
-        fields = dataclasses.fields(node)
-        field_child_ids = set()
-        for f in fields:
-            value = getattr(node, f.name)
+        node_children_ids = sorted(id(child) for child in node.children)
+        field_child_ids: List[int] = []
+        for name, kind in _classify_fields(type(node)):
+            value = getattr(node, name)
+            # Sequence fields may still be `Optional`, or a union with a single node
+            # (e.g. `ImportFrom.names`), so we can't skip the node check entirely.
             if isinstance(value, cst.CSTNode):
-                field_child_ids.add(id(value))
-            elif isinstance(value, Iterable):
-                field_child_ids.update(
+                field_child_ids.append(id(value))
+            elif kind is _FieldKind.NODE_SEQUENCE and value is not None:
+                # `NODE_SEQUENCE` fields only annotate elements as `CSTNode`
+                # subclasses, and `validate_node` already ran `validate_types_deep`
+                # against those annotations, so every element here is a `CSTNode`.
+                # Sequences with any other element type are `UNKNOWN`, and are
+                # filtered below.
+                field_child_ids.extend(map(id, value))
+            elif kind is _FieldKind.UNKNOWN and isinstance(value, Iterable):
+                field_child_ids.extend(
                     id(el) for el in value if isinstance(el, cst.CSTNode)
                 )
-
-        # order doesn't matter
-        self.assertSetEqual(
-            node_children_ids,
-            field_child_ids,
-            msg="`node.children` doesn't match what we found through introspection",
-        )
+        field_child_ids.sort()
+
+        # Order doesn't matter. Nodes only have a handful of children, so comparing
+        # sorted lists is cheaper than hashing into sets. Only fall back to comparing
+        # sets (which also ignores duplicates) on a mismatch, for a clearer message.
+        if node_children_ids != field_child_ids:
+            self.assertSetEqual(
+                set(node_children_ids),
+                set(field_child_ids),
+                msg="`node.children` doesn't match what we found through introspection",
+            )
 
     def __assert_visit_returns_identity(self, node: cst.CSTNode) -> None:
         """